@@ -19,15 +19,231 @@ display_help() {
     echo "   -r  --reference      Indexed reference genome"
     echo "   -u  --umi_length     UMI length, default is 12."
     echo "   -s  --spacer_length  How long is the spacer sequence? Default is 16."
-    echo "   -t  --threads        How many threads to use? Default is 16."
+    echo "   -t  --threads        How many threads to use in total? Default is 16."
+    echo "   -j  --jobs           How many samples to process in parallel? Threads are split between jobs. Default is 1."
     echo "   -f  --no_filtering   Do not use fastp to filter fastqs."
     echo "   -q  --phred_score          Min Phread score to keep when using fastp to filter. Default is 15, typical values are 10, 15, 20, 30."
     echo "   -p  --percent_low_quality  How many percent bases in a read are allowed to be below the thrshold q value. Default is 40 (0-100)"
     echo "   -e  --no-paired-end        Should paired-end reads be used. Default is yes, if the flag is set, only R1 will be used."       
+    echo "   -c  --compression_level    Gzip level (1-9) of the fastq files written by fastp. Default is 1."
+    echo "   -x  --intermediate_format  Compression of the filtered fastq files passed to umierrorcorrect, gz or zst. Default is gz."
+    echo "   -d  --direct               Stream filtered reads from fastp directly into umierrorcorrect instead of writing them to a file."
     echo
     exit 1
 }
 
+####################
+# Helper functions #
+####################
+
+# Decompress a fastq.gz file to stdout. rapidgzip decompresses in parallel
+# with the threads set aside for it next to fastp.
+decompress_fastq() {
+    if [[ $decompressor = "rapidgzip" ]]
+      then
+        $RAPIDGZIP -d -c -P $decompress_threads "$1"
+      else
+        $IGZIP -dc "$1"
+    fi
+}
+
+# Run fastp on a read pair. If rapidgzip or igzip is available the reads are
+# decompressed outside of fastp and passed to it through pipes. Fails if
+# either file cannot be decompressed.
+fastp_paired() {
+    local fq1=$1
+    local fq2=$2
+    shift 2
+
+    if [[ $decompressor != "" ]]
+      then
+        local status_dir=$(mktemp -d)
+        local status=0
+
+        # The status is written before the pipe is closed, so it is present
+        # once fastp has read all reads
+        $FASTP \
+          --in1=<(decompress_fastq $fq1; echo $? > "$status_dir/r1") \
+          --in2=<(decompress_fastq $fq2; echo $? > "$status_dir/r2") \
+          "$@" || status=$?
+
+        if (( status == 0 )) && [[ $(cat "$status_dir/r1" 2> /dev/null) != 0 || $(cat "$status_dir/r2" 2> /dev/null) != 0 ]]
+          then
+            printf '%s %s %s\n' $RED "...could not read read pair: $fq1 $fq2" $NC >&2
+            status=1
+        fi
+
+        rm -rf "$status_dir"
+        return $status
+      else
+        $FASTP --in1=$fq1 --in2=$fq2 "$@"
+    fi
+}
+
+# Print a key for a command, computed from the tool versions, its arguments
+# and the size and modification time (in nanoseconds) of every argument that
+# is an existing file. Of the --option=value arguments only the fastp inputs
+# --in1 and --in2 are checked, the others name output files. Thread counts
+# are left out, so that changing -t or -j does not rerun finished steps.
+step_key() {
+    local arg
+    local skip_next=false
+    {
+      printf '%s\n' "$tool_versions"
+      for arg in "$@"
+      do
+        if $skip_next
+          then
+            skip_next=false
+            continue
+        fi
+        case $arg in
+          --thread=*)
+            continue
+            ;;
+          -t)
+            skip_next=true
+            continue
+            ;;
+        esac
+
+        printf '%s\n' "$arg"
+        arg=${arg#--in[12]=}
+        if [[ -f $arg ]]
+          then
+            stat -c '%s %.9Y' "$arg" 2> /dev/null || stat -f '%z %Fm' "$arg"
+        fi
+      done
+    } | "${CHECKSUM[@]}" | cut -c 1-32
+}
+
+# Print the path of the file marking a finished command, see run_cached
+done_marker() {
+    printf '%s/.done_%s\n' "$1" "$(step_key "${@:2}")"
+}
+
+# Run a command unless it already finished successfully with the same
+# arguments and input files. Finished commands are marked with a .done_<key>
+# file in the directory given as first argument.
+run_cached() {
+    local done_file=$(done_marker "$@")
+    shift
+
+    if test -f "$done_file"
+      then
+        printf '%s %s %s\n' $YELLOW "...output is up to date, skipping $1." $NC
+        return 0
+    fi
+
+    "$@" && mkdir -p "$(dirname "$done_file")" && touch "$done_file"
+}
+
+# Like run_cached, but also runs the command again if the file given as second
+# argument, which it writes, was removed after it finished
+run_cached_output() {
+    if ! test -f "$2"
+      then
+        rm -f "$(done_marker "$1" "${@:3}")"
+    fi
+
+    run_cached "$1" "${@:3}"
+}
+
+# Run fastp and umierrorcorrect at the same time, passing the filtered reads
+# through a pipe instead of an intermediate file. Takes the name of the output
+# file, the fastp command and the umierrorcorrect arguments, separated by "--".
+# The output file is a link to /dev/fd/3, which is the write end of the pipe
+# for fastp and the read end for umierrorcorrect. Unlike a named pipe, opening
+# it never blocks, so either side can fail without the other waiting forever.
+stream_filtered_reads() {
+    local link=$1
+    local fastp_cmd=()
+    local statuses
+    shift
+
+    while [[ $1 != "--" ]]
+    do
+      fastp_cmd+=("$1")
+      shift
+    done
+    shift
+
+    rm -f "$link"
+    ln -s /dev/fd/3 "$link"
+
+    {
+      "${fastp_cmd[@]}" 3>&1 >&4 | $UMIERRORCORRECT "$@" 3<&0 < /dev/null
+      statuses=("${PIPESTATUS[@]}")
+    } 4>&1
+
+    rm -f "$link"
+
+    # Report fastp's status first, umierrorcorrect fails too if fastp did
+    if (( statuses[0] != 0 ))
+      then
+        return ${statuses[0]}
+    fi
+    return ${statuses[1]}
+}
+
+# Run a command that writes to the file given as first argument, and compress
+# everything written to it with zstd into <file>.zst. As in
+# stream_filtered_reads the file is a link to /dev/fd/3, the write end of a
+# pipe into zstd, so neither side can block the other.
+with_zstd_output() {
+    local link=$1
+    local statuses
+    shift
+
+    rm -f "$link"
+    ln -s /dev/fd/3 "$link"
+
+    {
+      "$@" 3>&1 >&4 | $ZSTD -T$zstd_threads --long=27 -1 -q -f -o "$link.zst"
+      statuses=("${PIPESTATUS[@]}")
+    } 4>&1
+
+    rm -f "$link"
+
+    # Do not leave a truncated or empty zstd file behind
+    if (( statuses[0] != 0 || statuses[1] != 0 ))
+      then
+        rm -f "$link.zst"
+        return 1
+    fi
+}
+
+# Run a command that reads from a file fed with the decompressed contents of
+# the zstd file given as first argument. The file is named like the zstd file
+# without the .zst suffix and is a link to /dev/fd/3, the read end of a pipe
+# from zstd.
+with_zstd_input() {
+    local zst_file=$1
+    local link=${1%.zst}
+    local statuses
+    shift
+
+    rm -f "$link"
+    ln -s /dev/fd/3 "$link"
+
+    $ZSTD -d -c --long=27 -q "$zst_file" | "$@" 3<&0 < /dev/null
+    statuses=("${PIPESTATUS[@]}")
+
+    rm -f "$link"
+
+    # The command's status first, zstd fails too if the command stopped early
+    if (( statuses[1] != 0 ))
+      then
+        return ${statuses[1]}
+    fi
+    return ${statuses[0]}
+}
+
+# Run umierrorcorrect, skipping samples that are already processed
+run_umierrorcorrect() {
+    run_cached $runDir/$sample_name $UMIERRORCORRECT "$@"
+}
+
 ##############################
 #   Initialize parameters    #
 ##############################
@@ -36,6 +252,7 @@ paired_end=true
 umi_length=19
 spacer_length=16
 threads=16
+jobs=1
 no_fastp=false
 use_bed=true
 filtering=true
@@ -43,6 +260,16 @@ phred_score=20
 percent_low_quality=40
 fastqc=false
 multiqc=false
+stream_filtered=false
+compression_level=1
+intermediate_format=gz
+decompressor=""
+
+# Read 1 files are named <sample>_R1_<number>.fastq.gz, the sample name is
+# everything before the _R1_ read token
+shopt -s extglob
+r1_pattern="*_R1_+([0-9]).fastq.gz"
+read_pattern="*_R[12]_+([0-9]).fastq.gz"
 
 # Initialize log file
 touch log.txt
@@ -51,7 +278,7 @@ touch log.txt
 # Check command line options #
 ##############################
 
-while getopts ':hfi:b:r:u:s:t:q:p:e:' option; do
+while getopts ':hfdi:b:r:u:s:t:j:q:p:e:c:x:' option; do
   case "$option" in
     h | --help)
         display_help
@@ -69,6 +296,15 @@ while getopts ':hfi:b:r:u:s:t:q:p:e:' option; do
     f | --no_filtering)
         filtering=false
         ;;
+    d | --direct)
+        stream_filtered=true
+        ;;
+    c | --compression_level)
+        compression_level=$OPTARG
+        ;;
+    x | --intermediate_format)
+        intermediate_format=$OPTARG
+        ;;
     u | --umi_length)
         umi_length=$OPTARG
         ;;
@@ -78,6 +314,9 @@ while getopts ':hfi:b:r:u:s:t:q:p:e:' option; do
     t | --threads)
         threads=$OPTARG
         ;;
+    j | --jobs)
+        jobs=$OPTARG
+        ;;
     q | --phred_score)
         phred_score=$OPTARG
         ;;
@@ -105,15 +344,35 @@ GREEN=$(tput setaf 2)
 RED=$(tput setaf 1)
 NC=$(tput sgr0)
 
+# Threads are split between jobs below, so both must be positive integers
+if ! [[ $threads =~ ^[1-9][0-9]*$ ]]
+  then
+    printf '%s %s %s %s\n' $RED "...number of threads must be a positive integer: " $NC $threads
+    exit 1
+fi
+
+if ! [[ $jobs =~ ^[1-9][0-9]*$ ]]
+  then
+    printf '%s %s %s %s\n' $RED "...number of jobs must be a positive integer: " $NC $jobs
+    exit 1
+fi
+
+# fastp only accepts gzip levels 1 to 9
+if ! [[ $compression_level =~ ^[1-9]$ ]]
+  then
+    printf '%s %s %s %s\n' $RED "...compression level must be an integer from 1 to 9: " $NC $compression_level
+    exit 1
+fi
+
 ##################################
 # Check file integrity and paths #
 ##################################
 
-# Check dependencies
+# Check dependencies, the full paths of the tools are kept and used below
 printf '%s %s %s\n' $GREEN "Checking dependencies..." $NC
 
 # Check if fastp is installed
-if ! command -v fastp &> /dev/null
+if ! FASTP=$(command -v fastp)
   then
     printf '%s %s\n' $YELLOW "...fastp could not be found. No filtering will be performed."
     printf '%s %s\n' "Please install fastp if you want to use filtering: " "https://github.com/OpenGene/fastp"
@@ -123,7 +382,7 @@ if ! command -v fastp &> /dev/null
   fi
 
 # Check if umierrorcorrect is installed
-if ! command -v run_umierrorcorrect.py &> /dev/null
+if ! UMIERRORCORRECT=$(command -v run_umierrorcorrect.py)
   then
     printf '%s %s\n' $RED "...umierrorcorrect could not be found."
     printf '%s\n' "Please install umierrorcorrect from: https://github.com/stahlberggroup/umierrorcorrect" $NC
@@ -143,7 +402,7 @@ if ! command -v bwa mem &> /dev/null
   fi
 
 # Check if multiqc is installed
-if ! command -v multiqc &> /dev/null
+if ! MULTIQC=$(command -v multiqc)
   then
     printf '%s %s %s\n' $YELLOW "...multiqc could not be found. No merged reports will be generated." $NC
     printf ' %s\n' "Please install multqic"
@@ -153,7 +412,7 @@ if ! command -v multiqc &> /dev/null
   fi
 
 # Check if fastqc is installed
-if ! command -v fastqc &> /dev/null
+if ! FASTQC=$(command -v fastqc)
   then
     printf '%s %s %s\n' $YELLOW "...fastqc could not be found. No merged reports will be generated." $NC
     printf ' %s\n' "Please install fastqc"
@@ -162,6 +421,54 @@ if ! command -v fastqc &> /dev/null
     fastqc=true
   fi
 
+# Check if rapidgzip or igzip (ISA-L) is installed
+if RAPIDGZIP=$(command -v rapidgzip)
+  then
+    printf '%s %s %s\n' $YELLOW "...rapidgzip is installed." $NC
+    decompressor="rapidgzip"
+elif IGZIP=$(command -v igzip)
+  then
+    printf '%s %s %s\n' $YELLOW "...igzip is installed." $NC
+    decompressor="igzip"
+  else
+    printf '%s %s %s\n' $YELLOW "...rapidgzip or igzip could not be found. fastp will decompress input files itself." $NC
+  fi
+
+# Check if zstd is installed when zstd compressed intermediate files are used
+if [[ $intermediate_format != "gz" && $intermediate_format != "zst" ]]
+  then
+    printf '%s %s %s %s\n' $RED "...unknown intermediate format, use gz or zst: " $NC $intermediate_format
+    exit
+elif [[ $intermediate_format = "zst" ]]
+  then
+    if ! ZSTD=$(command -v zstd)
+      then
+        printf '%s %s %s\n' $YELLOW "...zstd could not be found. Intermediate files will be gzip compressed." $NC
+        intermediate_format=gz
+      else
+        printf '%s %s %s\n' $YELLOW "...zstd is installed." $NC
+    fi
+fi
+
+# Checksum tool for the keys of finished steps
+if command -v b2sum &> /dev/null
+  then
+    CHECKSUM=(b2sum)
+  else
+    CHECKSUM=(shasum -a 256)
+fi
+
+# Versions of fastp and umierrorcorrect for the keys of finished steps, so that
+# upgrading either tool reruns all steps. umierrorcorrect has no version flag,
+# its help text starts with the version.
+tool_versions=$(
+  if [[ $FASTP != "" ]]
+    then
+      $FASTP --version 2>&1
+  fi
+  $UMIERRORCORRECT -h 2>&1
+)
+
 printf '%s %s %s\n' $GREEN "All dependencies are present." $NC
 
 # Check working directory
@@ -177,7 +484,24 @@ else
 fi
 
 # Detect fastq files
-n_files=`find $runDir -maxdepth 1 -name "*.fastq.gz" | wc -l | sed 's/^ *//g'`
+# List the directory once, the file names are reused when processing samples
+shopt -s nullglob
+fastq_files=( "$runDir"/*.fastq.gz )
+fastq_files=( "${fastq_files[@]##*/}" )
+shopt -u nullglob
+n_files=${#fastq_files[@]}
+
+# Order the files by inode number, which on most file systems follows their
+# placement on disk, so that samples are read closer to sequentially
+if (( n_files > 0 ))
+  then
+    sorted_files=()
+    while read -r inode name
+    do
+      sorted_files+=("$name")
+    done < <(cd "$runDir" && ls -1i -- "${fastq_files[@]}" | sort -n)
+    fastq_files=( "${sorted_files[@]}" )
+fi
 
 printf '%s %s %s %s\n' $YELLOW "...detecting fastqs: "  $NC "$n_files fastqs files found."
 
@@ -230,44 +554,69 @@ fi
 printf '\n%s %s %s\n' $GREEN "Processing $n_files fastq files..." $NC
 printf '%s %s %s %s\n' $YELLOW "...using UMI length:" $NC $umi_length
 printf '%s %s %s %s\n' $YELLOW "...using spacer length:" $NC $spacer_length
+# Split the threads between parallel jobs to avoid oversubscribing the cpus
+job_threads=$(( threads / jobs > 1 ? threads / jobs : 1 ))
+
+# Split the threads of a job between the tools running at the same time.
+# With -d umierrorcorrect runs next to fastp and each gets half. With -x zst
+# zstd compresses the fastp output, and for paired-end filtering R1 and R2
+# are decompressed next to fastp. fastp does most of the work and keeps the
+# largest share.
+fastp_threads=$job_threads
+umi_threads=$job_threads
+zstd_threads=1
+decompress_threads=1
+if $stream_filtered
+  then
+    umi_threads=$(( job_threads / 2 > 1 ? job_threads / 2 : 1 ))
+    fastp_threads=$(( job_threads - umi_threads ))
+elif [[ $intermediate_format = "zst" ]]
+  then
+    zstd_threads=$(( job_threads / 8 > 1 ? job_threads / 8 : 1 ))
+    fastp_threads=$(( job_threads - zstd_threads ))
+fi
+if [[ $decompressor != "" ]] && $paired_end
+  then
+    if [[ $decompressor = "rapidgzip" ]]
+      then
+        decompress_threads=$(( fastp_threads / 8 > 1 ? fastp_threads / 8 : 1 ))
+    fi
+    fastp_threads=$(( fastp_threads - 2 * decompress_threads ))
+fi
+fastp_threads=$(( fastp_threads > 1 ? fastp_threads : 1 ))
+
+# Limit implicit OpenMP/MKL threading in the tools to the same budget
+export OMP_NUM_THREADS=$job_threads
+export MKL_NUM_THREADS=$job_threads
+
 printf '%s %s %s %s\n' $YELLOW "...using threads:" $NC $threads
+printf '%s %s %s %s\n' $YELLOW "...using parallel jobs:" $NC $jobs
+printf '%s %s %s %s\n' $YELLOW "...using threads per job:" $NC $job_threads
+printf '%s %s %s %s\n' $YELLOW "...using fastp threads per job:" $NC $fastp_threads
+printf '%s %s %s %s\n' $YELLOW "...using umierrorcorrect threads per job:" $NC $umi_threads
 printf '%s %s %s %s\n' $YELLOW "...perform filtering:" $NC $do_filtering
 printf '%s %s %s %s\n' $YELLOW "...using bed annotations:" $NC $use_bed
+printf '%s %s %s %s\n' $YELLOW "...using intermediate format:" $NC $intermediate_format
+
+# Read the reference and its bwa index once so that parallel jobs map
+# against a warm page cache instead of all loading it from disk at once
+if (( jobs > 1 ))
+  then
+    printf '%s %s %s\n' $YELLOW "...loading reference into page cache." $NC
+    cat "$REF" "$REF".* > /dev/null 2>&1
+fi
 
 # Move to run directory
 cd $runDir
 
-# Processing fastq files
-for fastq in *.fastq.gz ;
-do
-  # If fastq file name contains "R1"
-  if [[ $fastq =~ R1 ]]
-    then
-    if $paired_end
-      then
-      # define read 1
-      fq1=$fastq 
-      printf '%s \n' $fq1
-
-      # define corresponding read 2 by replacing R1 with R2
-      fq2=${fastq//R1/R2} 
-      printf '%s \n' $fq2
-    else
-      # use only read 1
-      fq1=$fastq
-      printf '%s \n' $fq1
-    fi 
-  else
-    # If fastq file name does not contain "R1" continue with the next file
-    continue
-  fi
-  
-  # Define replacement
-  find="_R1_001.fastq.gz"
-  replace=""
+# Run filtering and umierrorcorrect for a single sample. Takes read 1 and
+# read 2 as arguments, read 2 is ignored for single-end data.
+process_sample() {
+  local fq1=$1
+  local fq2=$2
 
   # Simplify sample name
-  sample_name=${fq1//$find/$replace}
+  sample_name=${fq1%_R1_*}
 
   printf "\n%s %s %s %s\n" $GREEN "Changing sample name:" $NC "$fq1 => $sample_name" 
 
@@ -286,7 +635,7 @@ do
           then
             printf "%s\n" $GREEN "Using bed file."
 
-            run_umierrorcorrect.py \
+            run_umierrorcorrect \
               -o $runDir/$sample_name \
               -r1 $runDir/$fq1 \
               -r2 $runDir/$fq2 \
@@ -295,11 +644,11 @@ do
               -ul $umi_length \
               -sl $spacer_length \
               -bed $BED \
-              -t $threads
+              -t $job_threads
           else
             printf "%s\n" $YELLOW "NOT using bed file. This is not recommended."
 
-            run_umierrorcorrect.py \
+            run_umierrorcorrect \
               -o $runDir/$sample_name \
               -r1 $runDir/$fq1 \
               -r2 $runDir/$fq2 \
@@ -307,7 +656,7 @@ do
               -mode paired \
               -ul $umi_length \
               -sl $spacer_length \
-              -t $threads
+              -t $job_threads
           fi
         else
           # If data is not paired-end, use only R1
@@ -317,7 +666,7 @@ do
             then
               printf "%s\n" $GREEN "Using bed file."
 
-              run_umierrorcorrect.py \
+              run_umierrorcorrect \
                 -o $runDir/$sample_name \
                 -r1 $runDir/$fq1 \
                 -r $REF \
@@ -325,18 +674,18 @@ do
                 -ul $umi_length \
                 -sl $spacer_length \
                 -bed $BED \
-                -t $threads
+                -t $job_threads
           else
             printf "%s\n" $YELLOW "NOT using bed file. This is not recommended."
 
-            run_umierrorcorrect.py \
+            run_umierrorcorrect \
               -o $runDir/$sample_name \
               -r1 $runDir/$fq1 \
               -r $REF \
               -mode single \
               -ul $umi_length \
               -sl $spacer_length \
-              -t $threads
+              -t $job_threads
           fi
         fi
   else
@@ -349,85 +698,112 @@ do
           printf '%s %s %s %s\n' $GREEN "Using read 2..." $NC $fq2
           printf '%s %s %s %s\n' $YELLOW "...using minimum Phread score:" $NC $phred_score 
           printf '%s %s %s %s\n' $YELLOW "...using max percent low quality reads:" $NC $percent_low_quality
+          printf '%s %s %s %s\n' $YELLOW "...using compression level:" $NC $compression_level
 
-          # Define merged and filtered output file
+          # Define merged and filtered output file, when streaming or using zstd
+          # it is a pipe holding uncompressed reads
           outfile="$sample_name.merged.filtered.fastq.gz"
+          if $stream_filtered || [[ $intermediate_format = "zst" ]]
+            then
+              outfile=${outfile%.gz}
+          fi
 
-          # Run fastp
-          fastp \
-            --in1=$fq1 \
-            --in2=$fq2 \
+          # Define fastp command
+          fastp_cmd=(fastp_paired $fq1 $fq2 \
             --merge \
             --unpaired1="${sample_name}_unpaired.fastq.gz" \
             --unpaired2="${sample_name}_unpaired.fastq.gz" \
             --merged_out=$outfile \
             --failed_out="${sample_name}_failed.fastq.gz" \
-            --html "${sample_name}.html" \
             --trim_poly_g \
             --trim_poly_x \
             --qualified_quality_phred=$phred_score \
             --unqualified_percent_limit=$percent_low_quality \
             --detect_adapter_for_pe \
-            --thread=$threads \
+            --thread=$fastp_threads \
+            --compression=$compression_level \
             --correction \
             --n_base_limit=3 \
             --overlap_len_require=30  \
             --length_required=100 \
             --json="${sample_name}.json" \
             --html="${sample_name}.html" \
-            --report_title="${sample_name}"
+            --report_title="${sample_name}")
 
           else 
             printf '\n%s %s %s %s\n' $GREEN "Running fastp in single-end mode."
             printf '%s %s %s %s\n' $GREEN "Using read 1..." $NC $fq1
             printf '%s %s %s %s\n' $YELLOW "...using minimum Phread score:" $NC $phred_score 
             printf '%s %s %s %s\n' $YELLOW "...using max percent low quality reads:" $NC $percent_low_quality
+            printf '%s %s %s %s\n' $YELLOW "...using compression level:" $NC $compression_level
 
-            # Define filtered output file
+            # Define filtered output file, when streaming or using zstd it is a
+            # pipe holding uncompressed reads
             outfile="$sample_name.filtered.fastq.gz"
+            if $stream_filtered || [[ $intermediate_format = "zst" ]]
+              then
+                outfile=${outfile%.gz}
+            fi
 
-            fastp \
+            # Define fastp command
+            fastp_cmd=($FASTP \
             --in1=$fq1 \
             --out1=$outfile \
             --failed_out="${sample_name}_failed.fastq.gz" \
-            --html "${sample_name}.html" \
             --trim_poly_g \
             --trim_poly_x \
             --qualified_quality_phred=$phred_score \
             --unqualified_percent_limit=$percent_low_quality \
             --detect_adapter_for_pe \
-            --thread=$threads \
+            --thread=$fastp_threads \
+            --compression=$compression_level \
             --correction \
             --n_base_limit=3 \
             --length_required=100 \
             --json="${sample_name}.json" \
             --html="${sample_name}.html" \
-            --report_title="${sample_name}"
+            --report_title="${sample_name}")
           fi
 
-          printf '\n%s %s %s\n' $GREEN "Running umierrorcorrect for fastq: $outfile" $NC
-          printf "%s\n" $GREEN "Running UMIErrorCorrect in single-end mode."
-  
+          # Define umierrorcorrect arguments
+          umi_args=(-o $runDir/$sample_name \
+            -r1 $runDir/$outfile \
+            -r $REF \
+            -mode single \
+            -ul $umi_length \
+            -sl $spacer_length \
+            -t $umi_threads)
           if $use_bed
-          then
-            run_umierrorcorrect.py \
-              -o $runDir/$sample_name \
-              -r1 $runDir/$outfile \
-              -r $REF \
-              -mode single \
-              -ul $umi_length \
-              -sl $spacer_length \
-              -bed $BED \
-              -t $threads
-          else
-            run_umierrorcorrect.py \
-              -o $runDir/$sample_name \
-              -r1 $runDir/$outfile \
-              -r $REF \
-              -mode single \
-              -ul $umi_length \
-              -sl $spacer_length \
-              -t $threads
+            then
+              umi_args+=(-bed $BED)
+          fi
+
+          # Run fastp and umierrorcorrect
+          if $stream_filtered
+            then
+              printf '\n%s %s %s\n' $GREEN "Streaming fastp output into umierrorcorrect: $outfile" $NC
+              printf "%s\n" $GREEN "Running UMIErrorCorrect in single-end mode."
+
+              run_cached $runDir/$sample_name stream_filtered_reads $outfile "${fastp_cmd[@]}" -- "${umi_args[@]}"
+          elif [[ $intermediate_format = "zst" ]]
+            then
+              # Only run umierrorcorrect if fastp succeeded
+              run_cached_output $runDir/$sample_name $outfile.zst with_zstd_output $outfile "${fastp_cmd[@]}" &&
+              {
+                  printf '\n%s %s %s\n' $GREEN "Running umierrorcorrect for fastq: $outfile.zst" $NC
+                  printf "%s\n" $GREEN "Running UMIErrorCorrect in single-end mode."
+
+                  run_cached $runDir/$sample_name with_zstd_input $runDir/$outfile.zst $UMIERRORCORRECT "${umi_args[@]}"
+              }
+            else
+              # Only run umierrorcorrect if fastp succeeded
+              run_cached_output $runDir/$sample_name $outfile "${fastp_cmd[@]}" &&
+              {
+                  printf '\n%s %s %s\n' $GREEN "Running umierrorcorrect for fastq: $outfile" $NC
+                  printf "%s\n" $GREEN "Running UMIErrorCorrect in single-end mode."
+
+                  run_umierrorcorrect "${umi_args[@]}"
+              }
           fi
         else
           # If fastp is not used, print note to console
@@ -442,7 +818,7 @@ do
               then
                 printf "%s\n" $GREEN "Using bed file."
 
-                run_umierrorcorrect.py \
+                run_umierrorcorrect \
                   -o $runDir/$sample_name \
                   -r1 $runDir/$fq1 \
                   -r2 $runDir/$fq2 \
@@ -451,11 +827,11 @@ do
                   -ul $umi_length \
                   -sl $spacer_length \
                   -bed $BED \
-                  -t $threads
+                  -t $job_threads
               else
                 printf "%s\n" $YELLOW "NOT using bed file. This is not recommended."
 
-                run_umierrorcorrect.py \
+                run_umierrorcorrect \
                   -o $runDir/$sample_name \
                   -r1 $runDir/$fq1 \
                   -r2 $runDir/$fq2 \
@@ -463,7 +839,7 @@ do
                   -mode paired \
                   -ul $umi_length \
                   -sl $spacer_length \
-                  -t $threads
+                  -t $job_threads
               fi
             else
               # If data is not paired-end, use only R1
@@ -473,7 +849,7 @@ do
                 then
                   printf "%s\n" $GREEN "Using bed file."
 
-                  run_umierrorcorrect.py \
+                  run_umierrorcorrect \
                     -o $runDir/$sample_name \
                     -r1 $runDir/$fq1 \
                     -r $REF \
@@ -481,46 +857,192 @@ do
                     -ul $umi_length \
                     -sl $spacer_length \
                     -bed $BED \
-                    -t $threads
+                    -t $job_threads
               else
                 printf "%s\n" $YELLOW "NOT using bed file. This is not recommended."
 
-                run_umierrorcorrect.py \
+                run_umierrorcorrect \
                   -o $runDir/$sample_name \
                   -r1 $runDir/$fq1 \
                   -r $REF \
                   -mode single \
                   -ul $umi_length \
                   -sl $spacer_length \
-                  -t $threads
+                  -t $job_threads
               fi
             fi
 
 
       fi
     fi  
-  
+}
+
+# Run process_sample with its output collected in a temporary file that is
+# printed in one go once the sample is done, so that the output of samples
+# running in parallel is not interleaved
+process_sample_buffered() {
+  local buffer=$(mktemp)
+  local status
+
+  process_sample "$@" > "$buffer" 2>&1
+  status=$?
+  cat "$buffer"
+  rm -f "$buffer"
+  return $status
+}
+
+# Run fastqc with the given number of threads on the files given after it.
+# Files are passed in batches of 64 to keep below the argument length limit
+# and fastqc files are written to a dedicated folder. Reports are left zipped
+# and the input format is given to skip format detection.
+run_fastqc() {
+  local fastqc_threads=$1
+  shift
+
+  printf '%s\0' "$@" | \
+    xargs -0 -n 64 $FASTQC -t $fastqc_threads -o "$runDir/qc_reports" --noextract --quiet -f fastq
+}
+
+# Block until fewer than $jobs samples are running. wait -n (bash >= 4.3)
+# returns as soon as any sample finishes, older versions wait for the oldest.
+wait_for_slot() {
+  local pid
+  local running
+
+  while (( ${#pids[@]} >= jobs ))
+  do
+    if (( BASH_VERSINFO[0] > 4 || (BASH_VERSINFO[0] == 4 && BASH_VERSINFO[1] >= 3) ))
+      then
+        wait -n
+      else
+        wait ${pids[0]}
+    fi
+
+    # Keep only the samples that are still running
+    running=()
+    for pid in "${pids[@]}"
+    do
+      kill -0 $pid 2> /dev/null && running+=($pid)
+    done
+    pids=( "${running[@]}" )
+  done
+}
+
+# Stop the given background jobs and the tools they started. The children of
+# a job are listed before it is stopped, so that it cannot start new ones.
+kill_jobs() {
+  local pid
+  local children
+
+  for pid in "$@"
+  do
+    children=$(pgrep -P $pid)
+    kill $pid 2> /dev/null
+    kill_jobs $children
+  done
+}
+
+# Processing fastq files. With more than one job each sample is run as a
+# background job and at most $jobs samples are processed at the same time.
+# Background jobs ignore Ctrl-C, so they are stopped when the script is
+# interrupted or terminated.
+pids=()
+trap 'kill_jobs "${pids[@]}"; exit 130' INT TERM
+for fastq in "${fastq_files[@]}" ;
+do
+  # If fastq file name has the read 1 token "_R1_"
+  if [[ $fastq == $r1_pattern ]]
+    then
+    if $paired_end
+      then
+      # define read 1
+      fq1=$fastq 
+      printf '%s \n' $fq1
+
+      # define corresponding read 2 by replacing the _R1_ read token with _R2_.
+      # Other occurrences of R1, e.g. in a run name, are kept.
+      fq2=${fastq%_R1_*}_R2_${fastq##*_R1_}
+      printf '%s \n' $fq2
+    else
+      # use only read 1
+      fq1=$fastq
+      printf '%s \n' $fq1
+    fi 
+  else
+    # If fastq file name is not a read 1 file continue with the next file
+    continue
+  fi
+
+  if (( jobs > 1 ))
+    then
+      wait_for_slot
+      process_sample_buffered $fq1 $fq2 &
+      pids+=($!)
+    else
+      process_sample $fq1 $fq2
+  fi
 done
 
+# Run fastqc on the input read files in the same job slots as the samples, so
+# that it starts as soon as a slot is free instead of after the last sample.
+# Files written by fastp in an earlier run may be rewritten by samples that
+# are still running, they are left for after all samples are done.
+read_files=()
+for fastq in "${fastq_files[@]}"
+do
+  if [[ $fastq == $read_pattern ]]
+    then
+      read_files+=("$fastq")
+  fi
+done
+
+if $fastqc && (( ${#read_files[@]} > 0 ))
+  then
+    printf '\n%s %s %s\n' $GREEN "Running fastqc for input files in: $runDir" $NC
+    mkdir -p "$runDir/qc_reports"
+
+    if (( jobs > 1 ))
+      then
+        wait_for_slot
+        run_fastqc $job_threads "${read_files[@]}" &
+        pids+=($!)
+      else
+        run_fastqc $job_threads "${read_files[@]}"
+    fi
+fi
+
+# Wait for all samples to finish
+wait
+
 ###############################
 # Merging reports and cleanup #
 ###############################
 
-# Generate fastqc reports
+# Generate fastqc reports for the fastq files written by fastp
 if $fastqc
   then
-  printf '\n%s %s %s\n' $GREEN "Running fastqc for folder: $runDir" $NC
-  fastqc $runDir/*.fastq.gz
-fi  
+  new_files=()
+  shopt -s nullglob
+  for fastq in *.fastq.gz
+  do
+    if [[ " ${read_files[*]} " != *" $fastq "* ]]
+      then
+        new_files+=("$fastq")
+    fi
+  done
+  shopt -u nullglob
 
-# Move fastqc files to dedicated folder
-mkdir "$runDir/qc_reports"
-mv $runDir/*fastqc* qc_reports
+  if (( ${#new_files[@]} > 0 ))
+    then
+      printf '\n%s %s %s\n' $GREEN "Running fastqc for filtered files in: $runDir" $NC
+      run_fastqc $threads "${new_files[@]}"
+  fi
+fi  
 
 # Generate merged reports
 if $multiqc
   then
   printf '\n%s %s %s\n' $GREEN "Running multiqc for folder: $runDir" $NC
-  multiqc $runDir
+  $MULTIQC $runDir
 fi  
 